@@ -0,0 +1,264 @@
+import numpy as np
+import logging
+
+# numba是可选依赖：导入失败时NUMBA_AVAILABLE为False，
+# 调用方（如SpikeTrainAnalyzer.calculate_rates）应回退到纯NumPy的向量化路径
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    logging.info("numba not installed; kiana will use the pure-NumPy code paths.")
+
+
+def make_gaussian_kernel(sigma_bins, truncate=4.0):
+    """构建一个按±truncate·σ截断、归一化的高斯卷积核（以bin为单位）。"""
+    radius = max(int(truncate * sigma_bins + 0.5), 1)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-(x ** 2) / (2.0 * sigma_bins ** 2))
+    kernel /= kernel.sum()
+    return kernel
+
+
+if NUMBA_AVAILABLE:
+
+    # 注意：本内核不能开fastmath——带约束依赖inf哨兵值，fastmath下LLVM
+    # 假定没有无穷，np.isfinite的连通性检查会被常量折叠成True，断带时
+    # 直接回溯垃圾方向码。SIMD化的收益由不带band的_dtw_sym2_diag承担。
+    @njit(cache=True, boundscheck=False)
+    def _dtw_sym2(a, b, window, bt):
+        """symmetric2步进模式的DTW：返回warping path的(index1, index2)。
+
+        等价于dtw.dtw(|a_i - b_j|, step_pattern='symmetric2')的index1/index2，
+        但整个递推在jit后的原生循环里完成，没有逐格的Python回调。
+        递推只滚动prev/curr两行（热数据常驻L1/L2），回溯方向另存为
+        每格1字节的uint8矩阵——相比保留完整float64代价矩阵少搬8倍字节。
+
+        window >= 0时启用Sakoe-Chiba带约束：每行只计算对角线附近
+        （按m/n斜率居中）±window个格子，带外视为不可达。带太窄导致
+        首尾无法连通时返回空路径，由调用方报错。
+
+        bt为调用方提供的(n, m) uint8方向码矩阵（0=diag, 1=up, 2=left），
+        批量对齐时可跨调用复用；回溯只经过被计算过的格子，无需清零。
+        """
+        n = a.size
+        m = b.size
+        inf = np.inf
+        # 以输入dtype展开递推：float32输入时热行与代价全程4字节，
+        # 带宽减半（njit按dtype各自特化一份原生代码）
+        prev = np.full(m, inf, a.dtype)
+        curr = np.full(m, inf, a.dtype)
+        hi0 = m if window < 0 else min(m, window + 1)
+        prev[0] = np.abs(a[0] - b[0])
+        for j in range(1, hi0):
+            prev[j] = prev[j - 1] + np.abs(a[0] - b[j])
+            bt[0, j] = 2
+        for i in range(1, n):
+            if window >= 0:
+                center = (i * m) // n
+                lo = max(1, center - window)
+                hi = min(m, center + window + 1)
+            else:
+                lo = 1
+                hi = m
+            for j in range(m):
+                curr[j] = inf
+            if window < 0 or (i * m) // n - window <= 0:
+                curr[0] = prev[0] + np.abs(a[i] - b[0])
+                bt[i, 0] = 1
+            for j in range(lo, hi):
+                c = np.abs(a[i] - b[j])
+                # 写成c+c而不是2.0*c，避免float32输入被float64字面量提升
+                d = prev[j - 1] + (c + c)
+                u = prev[j] + c
+                l = curr[j - 1] + c
+                # 两段“严格小于才替换”的选择让LLVM生成条件移动而不是
+                # 分支，热循环里没有可被误预测的跳转；语义仍是平局时
+                # 对角优先、再纵向，与回溯约定保持一致
+                best = d
+                move = np.uint8(0)
+                if u < best:
+                    best = u
+                    move = np.uint8(1)
+                if l < best:
+                    best = l
+                    move = np.uint8(2)
+                curr[j] = best
+                bt[i, j] = move
+            prev, curr = curr, prev
+        if not np.isfinite(prev[m - 1]):
+            # 带约束下首尾不连通
+            return np.empty(0, np.int32), np.empty(0, np.int32)
+        return _backtrack(bt)
+
+    @njit(cache=True, boundscheck=False)
+    def _backtrack(bt):
+        """沿uint8方向码矩阵从(n-1, m-1)回溯到(0, 0)，返回正序路径。"""
+        n, m = bt.shape
+        p1 = np.empty(n + m, np.int32)
+        p2 = np.empty(n + m, np.int32)
+        i = n - 1
+        j = m - 1
+        k = 0
+        # 合法路径最长n+m-1步；显式限定迭代数，方向码若因上游bug损坏
+        # 也不会越过p1/p2的边界写内存
+        for _ in range(n + m):
+            p1[k] = i
+            p2[k] = j
+            k += 1
+            if i == 0 and j == 0:
+                break
+            move = bt[i, j]
+            if move == 0:
+                i -= 1
+                j -= 1
+            elif move == 1:
+                i -= 1
+            else:
+                j -= 1
+        return p1[:k][::-1].copy(), p2[:k][::-1].copy()
+
+    @njit(cache=True, boundscheck=False, fastmath=True)
+    def _dtw_sym2_diag(a, b, bt):
+        """_dtw_sym2的反对角线（wavefront）版本，用于不带band的全矩阵递推。
+
+        行扫描的内循环经由curr[j-1]存在循环携带依赖，编译器无法SIMD；
+        同一条反对角线上的格子互不依赖——(i, j)的三个前驱都落在前两条
+        对角线上——把递推改成沿i+j=d的波前推进后，内循环就是纯粹的
+        加法+三路min，LLVM可以按4路float64/8路float32打包执行。
+        三条对角线缓冲按i下标索引、滚动复用，回溯仍走uint8方向码；
+        bt矩阵与_dtw_sym2一样由调用方提供、可复用。
+        """
+        n = a.size
+        m = b.size
+        inf = np.inf
+        prev2 = np.full(n, inf, a.dtype)
+        prev1 = np.full(n, inf, a.dtype)
+        curr = np.full(n, inf, a.dtype)
+        prev1[0] = np.abs(a[0] - b[0])  # d=0只有(0,0)
+        if n == 1 and m == 1:
+            return _backtrack(bt)
+        for d in range(1, n + m - 1):
+            lo = max(0, d - m + 1)
+            hi = min(n - 1, d)
+            for i in range(n):
+                curr[i] = inf
+            # 两类边界格只有单一前驱
+            if lo == 0:
+                curr[0] = prev1[0] + np.abs(a[0] - b[d])
+                bt[0, d] = 2
+            if hi == d:
+                curr[d] = prev1[d - 1] + np.abs(a[d] - b[0])
+                bt[d, 0] = 1
+            # 内部格：无循环携带依赖，可被SIMD向量化
+            for i in range(max(lo, 1), min(hi, d - 1) + 1):
+                c = np.abs(a[i] - b[d - i])
+                dd = prev2[i - 1] + (c + c)
+                u = prev1[i - 1] + c
+                l = prev1[i] + c
+                best = dd
+                move = np.uint8(0)
+                if u < best:
+                    best = u
+                    move = np.uint8(1)
+                if l < best:
+                    best = l
+                    move = np.uint8(2)
+                curr[i] = best
+                bt[i, d - i] = move
+            prev2, prev1, curr = prev1, curr, prev2
+        return _backtrack(bt)
+
+    @njit(cache=True)
+    def _pair_scatter(task_ids, ephys_ids, conservative):
+        """DTW配对净化+scatter的jit版本：返回task_id -> ephys_id映射数组。
+
+        语义与utils._purify_pairs两段清理完全一致（每个key保留最小value，
+        非conservative时先按ephys再按task各做一遍），但用两趟原生循环
+        代替lexsort，复杂度从O(K log K)降为O(K + max_id)。
+        """
+        num_pairs = task_ids.size
+        if not conservative:
+            # 第一遍：每个ephys_id保留最小的task_id
+            max_ephys = 0
+            for k in range(num_pairs):
+                if ephys_ids[k] > max_ephys:
+                    max_ephys = ephys_ids[k]
+            best_task = np.full(max_ephys + 1, -1, np.int64)
+            for k in range(num_pairs):
+                t = task_ids[k]
+                e = ephys_ids[k]
+                if best_task[e] < 0 or t < best_task[e]:
+                    best_task[e] = t
+            # 第二遍：幸存配对中每个task_id保留最小的ephys_id；
+            # 按ephys升序扫描，首次写入即最小值
+            max_task = 0
+            for e in range(max_ephys + 1):
+                if best_task[e] > max_task:
+                    max_task = best_task[e]
+            out = np.full(max_task + 1, np.nan)
+            for e in range(max_ephys + 1):
+                t = best_task[e]
+                if t >= 0 and np.isnan(out[t]):
+                    out[t] = float(e)
+            return out
+        else:
+            max_task = 0
+            for k in range(num_pairs):
+                if task_ids[k] > max_task:
+                    max_task = task_ids[k]
+            out = np.full(max_task + 1, np.nan)
+            for k in range(num_pairs):
+                t = task_ids[k]
+                e = float(ephys_ids[k])
+                if np.isnan(out[t]) or e < out[t]:
+                    out[t] = e
+            return out
+
+    @njit(parallel=True, cache=True)
+    def _spikes_in_windows(spike_train, lo, hi, starts, offsets, flat):
+        """按窗口并行地把排序spike train的切片搬进CSR布局的flat数组。
+
+        lo/hi为searchsorted得到的各窗口切片边界，offsets为累加好的
+        输出偏移；各窗口写入区间互不重叠，prange下无写冲突。
+        """
+        for k in prange(lo.size):
+            base = offsets[k]
+            start = starts[k]
+            for idx in range(lo[k], hi[k]):
+                flat[base + idx - lo[k]] = spike_train[idx] - start
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _bin_and_smooth(flat_spikes, trial_offsets, min_t, bin_size, nbins, kernel, out):
+        """逐trial做直方图+高斯卷积，并行写入预分配的(T, nbins)矩阵。
+
+        flat_spikes为所有trial拼接后的相对spike时间（CSR布局），
+        trial_offsets[i]:trial_offsets[i+1]切出第i个trial。
+        kernel长度为1时退化为纯分bin（binned模式）。
+        """
+        num_trials = trial_offsets.size - 1
+        radius = kernel.size // 2
+        for i in prange(num_trials):
+            counts = np.zeros(nbins)
+            for k in range(trial_offsets[i], trial_offsets[i + 1]):
+                b = int((flat_spikes[k] - min_t) / bin_size)
+                if 0 <= b < nbins:
+                    counts[b] += 1.0
+            if kernel.size > 1:
+                for j in range(nbins):
+                    acc = 0.0
+                    for t in range(-radius, radius + 1):
+                        jj = j + t
+                        # 与scipy的'reflect'边界模式一致（(dcba|abcd|dcba)），
+                        # 保证numba与numpy两个engine在窗口边缘也给出相同的rate；
+                        # 核半径超过nbins时反复折叠直到落回窗口内
+                        while jj < 0 or jj >= nbins:
+                            if jj < 0:
+                                jj = -jj - 1
+                            else:
+                                jj = 2 * nbins - jj - 1
+                        acc += counts[jj] * kernel[t + radius]
+                    out[i, j] = acc / bin_size
+            else:
+                for j in range(nbins):
+                    out[i, j] = counts[j] / bin_size
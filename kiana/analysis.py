@@ -1,15 +1,68 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import sem
-from scipy.ndimage import gaussian_filter1d
+from scipy.ndimage import convolve1d
 import logging
 
+from collections.abc import Sequence
+
+from ._fastcore import make_gaussian_kernel
+
+class _RelSpikes(Sequence):
+    """
+    Lazy per-trial view over a sorted spike vector.
+
+    只保存每个trial在排序spike向量中的(start, end)切片句柄和对齐偏移，
+    访问某个trial时才物化`sorted_spikes[s:e] - offset`。下游只画部分trial
+    或只需要拼接视图时，省去T个中间数组的分配。
+    """
+    def __init__(self, sorted_spikes, starts, ends, offsets):
+        self._spikes = sorted_spikes
+        self._starts = starts
+        self._ends = ends
+        self._offsets = np.asarray(offsets)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, i):
+        return self._spikes[self._starts[i]:self._ends[i]] - self._offsets[i]
+
+    @property
+    def counts(self):
+        """每个trial窗口内的spike数，不物化任何切片。"""
+        return self._ends - self._starts
+
+    def bounds(self):
+        """全部trial相对spike的(min, max)；没有任何spike时返回None。
+
+        排序向量里每个切片的首/尾元素就是该trial的最值，
+        直接按句柄读取端点即可，无需拼接或物化。
+        """
+        nonempty = self._ends > self._starts
+        if not np.any(nonempty):
+            return None
+        mins = self._spikes[self._starts[nonempty]] - self._offsets[nonempty]
+        maxs = self._spikes[self._ends[nonempty] - 1] - self._offsets[nonempty]
+        return mins.min(), maxs.max()
+
+    def concatenated(self):
+        """所有trial的相对spike拼成一个向量（等价于np.concatenate(self)）。"""
+        counts = self.counts
+        trial_of = np.repeat(np.arange(len(counts)), counts)
+        flat_start = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        within = np.arange(int(counts.sum())) - np.repeat(flat_start, counts)
+        return self._spikes[self._starts[trial_of] + within] - self._offsets[trial_of]
+
+
 class SpikeTrainAnalyzer:
     """
     An advanced, modular analyzer for neuronal spike trains.
     """
     def __init__(self, spike_train, event_windows, alignment_times=None, extra_events=None, font_prop=None, **kwargs):
         self.spike_train = np.asarray(spike_train)
+        # 排序一次，后续所有窗口切片都可以用searchsorted二分查找，
+        # 避免每个trial对整个spike_train做一次布尔掩码（O(N·T) -> O(T·logN)）
+        self._sorted_spikes = np.sort(self.spike_train)
         self.event_windows = np.asarray(event_windows)
         self.num_trials = len(self.event_windows)
         if alignment_times is None:
@@ -26,6 +79,9 @@ class SpikeTrainAnalyzer:
             'baseline_color': 'red', 'align_line_color': 'black',
         }
         self.plot_params.update(kwargs)
+        self._kernel_cache = {}
+        self._stats_cache = {}
+        self._rel_events_cache = {}
         self._precompute_relative_spikes()
         self._precompute_relative_events()
         self.time_vector, self.rates_matrix, self.calculation_mode, self.bin_size = None, None, None, None
@@ -76,10 +132,12 @@ class SpikeTrainAnalyzer:
         return self.relative_spikes
 
     def _precompute_relative_spikes(self):
-        self.relative_spikes = []
-        for i in range(self.num_trials):
-            win_spikes = self.spike_train[(self.spike_train >= self.event_windows[i, 0]) & (self.spike_train < self.event_windows[i, 1])]
-            self.relative_spikes.append(win_spikes - self.align_points[i])
+        # 在已排序的spike向量上用两次searchsorted一次性定位所有窗口的边界，
+        # 每个trial只做一次切片+减法，不再分配整长的布尔掩码
+        starts = np.searchsorted(self._sorted_spikes, self.event_windows[:, 0], side='left')
+        ends = np.searchsorted(self._sorted_spikes, self.event_windows[:, 1], side='left')
+        # 只保留切片句柄，按需物化（见_RelSpikes）
+        self.relative_spikes = _RelSpikes(self._sorted_spikes, starts, ends, self.align_points)
     
     def _precompute_relative_events(self):
         self.relative_events = {}
@@ -92,13 +150,21 @@ class SpikeTrainAnalyzer:
                 relative_event_times.append(trial_event_times - self.align_points[i])
             self.relative_events[event_name] = relative_event_times
 
+    def _get_gaussian_kernel(self, std, time_bin_size):
+        # 截断高斯核只依赖(std, bin宽)，缓存起来让重复的calculate_rates调用
+        # 跳过np.exp重算——SciPy的gaussian_filter1d每次调用都会重建这组系数
+        key = (std, time_bin_size)
+        if key not in self._kernel_cache:
+            self._kernel_cache[key] = make_gaussian_kernel(std / time_bin_size)
+        return self._kernel_cache[key]
+
     def _determine_time_window(self, analysis_window=None):
         if analysis_window is None:
-            all_spikes_flat = np.concatenate(self.relative_spikes)
-            if all_spikes_flat.size == 0:
+            bounds = self.relative_spikes.bounds()
+            if bounds is None:
                 print("Warning: No spikes found. Using default plot range [-1, 1].")
                 return -1.0, 1.0
-            min_time, max_time = all_spikes_flat.min(), all_spikes_flat.max()
+            min_time, max_time = bounds
             padding = (max_time - min_time) * 0.05
             return min_time - padding, max_time + padding
         else:
@@ -108,9 +174,10 @@ class SpikeTrainAnalyzer:
         # 这个calculate rates是计算event_window范围内的
         self.calculation_mode = mode
         if mode == 'gaussian':
-            std = kwargs.get('gaussian_std', 0.02); 
+            std = kwargs.get('gaussian_std', 0.02);
             time_bin_size = kwargs.get('high_res_bin', 0.001)
-            post_processor = lambda rate_arr: gaussian_filter1d(rate_arr, sigma=std / time_bin_size); 
+            kernel = self._get_gaussian_kernel(std, time_bin_size)
+            post_processor = lambda rate_arr: convolve1d(rate_arr, kernel);
             self.bin_size = None
         elif mode == 'binned':
             time_bin_size = kwargs.get('bin_size', 0.1)
@@ -174,24 +241,51 @@ class SpikeTrainAnalyzer:
     def calculate_rates(self, mode='gaussian', analysis_window=None, **kwargs):
         self.calculation_mode = mode
         if mode == 'gaussian':
-            std = kwargs.get('gaussian_std', 0.02); 
+            std = kwargs.get('gaussian_std', 0.02);
             time_bin_size = kwargs.get('high_res_bin', 0.001)
-            post_processor = lambda rate_arr: gaussian_filter1d(rate_arr, sigma=std / time_bin_size); 
             self.bin_size = None
         elif mode == 'binned':
             time_bin_size = kwargs.get('bin_size', 0.1)
-            post_processor = lambda rate_arr: rate_arr; 
             self.bin_size = time_bin_size
         else: raise ValueError(f"Mode '{mode}' not recognized. Use 'gaussian' or 'binned'.")
         min_t, max_t = self._determine_time_window(analysis_window)
         self.time_vector = np.arange(min_t, max_t, time_bin_size)
-        all_trial_rates = []
-        histogram_bins = np.append(self.time_vector, self.time_vector[-1] + time_bin_size)
-        for rel_spikes in self.relative_spikes:
-            counts, _ = np.histogram(rel_spikes, bins=histogram_bins)
-            initial_rate = counts / time_bin_size
-            all_trial_rates.append(post_processor(initial_rate))
-        self.rates_matrix = np.array(all_trial_rates)
+        nbins = len(self.time_vector)
+        spike_counts = self.relative_spikes.counts
+        flat_spikes = self.relative_spikes.concatenated()
+        # 可选的numba引擎：逐trial直方图+卷积的jit内核，多trial场景下并行加速。
+        # numba未安装时回退到下面的向量化路径
+        if kwargs.get('engine', 'numpy') == 'numba':
+            from . import _fastcore
+            if _fastcore.NUMBA_AVAILABLE:
+                trial_offsets = np.concatenate(([0], np.cumsum(spike_counts))).astype(np.int64)
+                if mode == 'gaussian':
+                    kernel = _fastcore.make_gaussian_kernel(std / time_bin_size)
+                else:
+                    kernel = np.ones(1)
+                self.rates_matrix = np.empty((self.num_trials, nbins), dtype=np.float32)
+                _fastcore._bin_and_smooth(flat_spikes.astype(np.float64), trial_offsets,
+                                          float(min_t), float(time_bin_size), nbins,
+                                          kernel, self.rates_matrix)
+                self._stats_cache = {}
+                print(f"Rates calculated via '{mode}' mode.")
+                return self
+            print("Warning: numba is not installed. Falling back to the vectorized engine.")
+        # 把所有trial的spike拼成一个向量，配合trial编号做一次bincount，
+        # 取代逐trial调用np.histogram（C层的digitize只跑一次，Python循环开销归零）
+        trial_idx = np.repeat(np.arange(self.num_trials), spike_counts)
+        time_bin = np.floor((flat_spikes - min_t) / time_bin_size).astype(np.intp)
+        in_range = (time_bin >= 0) & (time_bin < nbins)
+        flat_idx = trial_idx[in_range] * nbins + time_bin[in_range]
+        counts = np.bincount(flat_idx, minlength=self.num_trials * nbins).reshape(self.num_trials, nbins)
+        # 发放率用float32存储足够（下游mean/SEM/绘图的带宽减半）
+        rates = counts.astype(np.float32) / time_bin_size
+        if mode == 'gaussian':
+            # 对整个(T, nbins)矩阵沿时间轴做一次平滑：截断高斯核取自缓存，
+            # 行间循环由SciPy在C层完成
+            rates = convolve1d(rates, self._get_gaussian_kernel(std, time_bin_size), axis=1)
+        self.rates_matrix = rates
+        self._stats_cache = {}
         print(f"Rates calculated via '{mode}' mode.")
         return self
 
@@ -201,21 +295,50 @@ class SpikeTrainAnalyzer:
         return ax.get_figure(), ax
     def _calculate_baseline_rate(self, baseline_window):
         if baseline_window is None: return None
-        total_spikes, total_duration = 0, 0
-        for i in range(self.num_trials):
-            abs_start, abs_end = self.align_points[i] + baseline_window[0], self.align_points[i] + baseline_window[1]
-            total_spikes += np.sum((self.spike_train >= abs_start) & (self.spike_train < abs_end))
-            total_duration += (abs_end - abs_start)
-        return total_spikes / total_duration if total_duration > 0 else 0
+        # 一次性在排序后的spike向量上查找所有trial的baseline窗口边界，
+        # 用searchsorted的差值直接得到每个窗口内的spike数，免去逐trial的全长掩码
+        abs_starts = self.align_points + baseline_window[0]
+        abs_ends = self.align_points + baseline_window[1]
+        counts = (np.searchsorted(self._sorted_spikes, abs_ends, side='left')
+                  - np.searchsorted(self._sorted_spikes, abs_starts, side='left'))
+        total_duration = self.num_trials * (baseline_window[1] - baseline_window[0])
+        return counts.sum() / total_duration if total_duration > 0 else 0
     
+    def _get_mean_sem(self, rates, cache_key):
+        # mean/SEM按rates_matrix和分组标签缓存：plot_raster会级联调用plot_psth，
+        # 同一份矩阵不必重复归约。SEM手动按std(ddof=1)/sqrt(N)计算，
+        # 绕开scipy.stats.sem在热路径上的NaN检查和分发开销
+        if cache_key not in self._stats_cache:
+            mean_rate = rates.mean(axis=0)
+            sem_rate = rates.std(axis=0, ddof=1) / np.sqrt(rates.shape[0])
+            self._stats_cache[cache_key] = (mean_rate, sem_rate)
+        return self._stats_cache[cache_key]
+
     def _get_relative_events(self, extra_events):
+        """
+        Returns the (event_name, relative_times, trial_indices) tuples for the
+        given extra events, computing them once per event dict and caching the
+        result so raster and PSTH panels of the same figure don't redo the
+        hit-matrix association.
+        """
+        if extra_events is None:
+            return ()
+        cache_key = id(extra_events)
+        # id会随dict被回收而复用：缓存里同时留存被键引用的dict本身
+        # （既防止其被释放，也便于命中时用is确认还是同一个对象），
+        # 否则连续传入不同的临时dict会静默拿到上一次的结果
+        cached = self._rel_events_cache.get(cache_key)
+        if cached is None or cached[0] is not extra_events:
+            cached = (extra_events, list(self._compute_relative_events(extra_events)))
+            self._rel_events_cache[cache_key] = cached
+        return cached[1]
+
+    def _compute_relative_events(self, extra_events):
         """
         Calculates relative event times by associating events to trials based on
         whether they fall within the trial's specific event_window.
         This is the corrected logic based on user feedback.
         """
-        if extra_events is None:
-            return
         # 提取所有窗口的开始和结束时间，方便调用
         window_starts = self.event_windows[:, 0]
         window_ends = self.event_windows[:, 1]
@@ -276,28 +399,35 @@ class SpikeTrainAnalyzer:
         # 3. 根据是否提供 trial_labels，决定绘制总平均还是分组平均
         if trial_labels is None:
             # --- 原始行为: 绘制总平均 ---
-            mean_rate = np.mean(self.rates_matrix, axis=0)
-            sem_rate = sem(self.rates_matrix, axis=0)
+            mean_rate, sem_rate = self._get_mean_sem(self.rates_matrix, (id(self.rates_matrix), None))
             ax.plot(plot_x, mean_rate, color=params['mean_trace_color'], lw=2.5, label='Mean Rate', drawstyle=drawstyle)
             if drawstyle == 'default':
                 ax.fill_between(plot_x, mean_rate - sem_rate, mean_rate + sem_rate, color=params['sem_shade_color'], alpha=0.5, label='SEM', zorder=-1)
         else:
             # --- 新功能: 按条件分组绘制 ---
-            unique_labels = sorted(list(np.unique(trial_labels)))
+            # 按标签稳定排序后用np.add.reduceat一次扫过矩阵得到每组的和与平方偏差，
+            # 取代逐组布尔掩码（G次全矩阵遍历 -> 1次）
+            labels_arr = np.asarray(trial_labels)
+            cache_key = (id(self.rates_matrix), tuple(labels_arr.tolist()))
+            if cache_key not in self._stats_cache:
+                order = np.argsort(labels_arr, kind='stable')
+                sorted_rates = self.rates_matrix[order]
+                sorted_labels = labels_arr[order]
+                group_starts = np.concatenate(([0], np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1]) + 1))
+                counts = np.diff(np.append(group_starts, len(sorted_labels)))
+                means = np.add.reduceat(sorted_rates, group_starts, axis=0) / counts[:, None]
+                group_id = np.repeat(np.arange(len(group_starts)), counts)
+                dev2 = np.add.reduceat((sorted_rates - means[group_id]) ** 2, group_starts, axis=0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    sems = np.sqrt(dev2 / (counts - 1)[:, None]) / np.sqrt(counts)[:, None]
+                sems[counts == 1] = np.nan  # 单trial组无SEM，与scipy.stats.sem一致
+                self._stats_cache[cache_key] = (sorted_labels[group_starts], means, sems)
+            unique_labels, means, sems = self._stats_cache[cache_key]
             prop_cycler = plt.rcParams['axes.prop_cycle']
             colors = prop_cycler.by_key()['color']
-            
+
             for i, label in enumerate(unique_labels):
-                # 找到当前条件对应的所有trials
-                indices = np.where(np.array(trial_labels) == label)[0]
-                if len(indices) == 0: continue
-                
-                # 为当前条件计算均值和SEM
-                group_rates = self.rates_matrix[indices]
-                mean_rate = np.mean(group_rates, axis=0)
-                sem_rate = sem(group_rates, axis=0)
-                
-                # 获取颜色并绘图
+                mean_rate, sem_rate = means[i], sems[i]
                 color = colors[i % len(colors)]
                 ax.plot(plot_x, mean_rate, color=color, lw=2.5, label=f'Mean ({label})', drawstyle=drawstyle)
                 if drawstyle == 'default':
@@ -423,7 +553,7 @@ class SpikeTrainAnalyzer:
 
         trial_labels = kwargs.pop('trial_labels', None)  # Pop from kwargs
         legend_out = kwargs.pop('legend_out', True)  # Pop legend_out to control legend visibility
-        psth_kwargs = {k: v for k, v in kwargs.items() if k in self.plot_psth.__code__.co_varnames or k in ['baseline_window', 'extra_events', 'title', 'mean_trace_color']}
+        psth_kwargs = {k: v for k, v in kwargs.items() if k in self._PSTH_KWARG_NAMES}
         raster_kwargs = {k: v for k, v in kwargs.items() if k not in psth_kwargs}
         # trial_labels = raster_kwargs.pop('trial_labels', None) # Pop from raster_kwargs
         # if trial_labels is not None:
@@ -456,5 +586,13 @@ class SpikeTrainAnalyzer:
         if show_psth: ax_psth.set_xlabel("Time from Alignment (s)", fontproperties=self.font_prop)
         else: ax_raster.set_xlabel("Time from Alignment (s)", fontproperties=self.font_prop)
         fig.tight_layout(rect=[0, 0.03, 1, 0.95])
-        
+
         return fig, (ax_raster, ax_psth) if show_psth else ax_raster
+
+
+# plot_raster筛选kwargs用的名字集合在模块导入时固化成frozenset，
+# 避免每次绘图、每个kwarg都线性扫描co_varnames元组
+SpikeTrainAnalyzer._PSTH_KWARG_NAMES = (
+    frozenset(SpikeTrainAnalyzer.plot_psth.__code__.co_varnames)
+    | {'baseline_window', 'extra_events', 'title', 'mean_trace_color'}
+)
@@ -3,25 +3,21 @@ import numpy as np
 import logging
 from scipy.io import loadmat
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
+from datetime import datetime
 import struct
 import os
 
 def _array_to_datetime(arr):
-    # 提取各字段（转换为整数）
-    year = int(arr[0])
-    month = int(arr[1])
-    day = int(arr[2])
-    hour = int(arr[3])
-    minute = int(arr[4])
-    
+    # 一次批量转换前五个字段，避免逐个Python级的float->int强制转换
+    year, month, day, hour, minute = np.asarray(arr[:5], dtype=np.float64).astype(np.int64)
+
     # 处理秒和微秒
-    seconds_total = arr[5]
+    seconds_total = float(arr[5])
     seconds = int(seconds_total)
     microseconds = int(round((seconds_total - seconds) * 1e6))  # 四舍五入
-    
+
     # 返回 datetime 对象
-    return datetime(year, month, day, hour, minute, seconds, microseconds)
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), seconds, microseconds)
 
 class BaseLoader(ABC):
     def __init__(self, trial_id_col: str = 'TrialID'):
@@ -48,12 +44,18 @@ class MatLoader(BaseLoader):
         
         self.notation_map = notation_map or {}
         self.load_all = load_all
+        # 把区间表按起点排序成数组，查表时用searchsorted二分，
+        # 免去解析循环里每个trial对notation_map的线性扫描
+        sorted_items = sorted(self.notation_map.items(), key=lambda kv: kv[1][0])
+        self._notation_starts = np.array([start for _, (start, _) in sorted_items])
+        self._notation_ends = np.array([end for _, (_, end) in sorted_items])
+        self._notation_names = [name for name, _ in sorted_items]
         logging.info(f"MatLoader initialized with notation map: {list(self.notation_map.keys())}")
 
     def _get_trial_notation(self, trial_id: int) -> str:
-        for name, (start, end) in self.notation_map.items():
-            if start <= trial_id <= end:
-                return name
+        i = np.searchsorted(self._notation_starts, trial_id, side='right') - 1
+        if i >= 0 and trial_id <= self._notation_ends[i]:
+            return self._notation_names[i]
         return "Unknown"
 
     def load(self, filepath: str, **kwargs) -> pd.DataFrame:
@@ -72,8 +74,12 @@ class MatLoader(BaseLoader):
         if 'Trial1' not in data:
             raise ValueError(f"Invalid .mat file structure: Missing 'Trial1' key. Data keys: {data.keys()}")
         start_datetime = _array_to_datetime(data['Trial1']['TrialDateTime'])
-        
-        all_records = []
+
+        # SoA式收集：trial级信息每trial只存一份dict，事件只记录
+        # (trial行号, 事件码, 事件时刻)三列，最后由pandas在C层把trial信息
+        # 广播到每个事件行——不再为每个事件复制base_info
+        trial_infos = []
+        event_trial_rows, event_code_col, event_time_chunks = [], [], []
         if "TrialRecord" not in data:
             total_trial_num = 1
             while f"Trial{total_trial_num}" in data:
@@ -112,32 +118,40 @@ class MatLoader(BaseLoader):
                     base_info.update(user_vars)
                     base_info.update(variable_changes)
 
+                trial_row = len(trial_infos)
+                trial_infos.append(base_info)
+
                 def record_event(event_type, event_times):
-                    for event_time in event_times:
-                        record = base_info.copy()
-                        event_time_sec = (event_time + start_time_ms) / 1000.0
-                        record.update({
-                            'BehavioralCode': event_type,
-                            'EventTime': event_time_sec,
-                            'AbsoluteDateTime': start_datetime + timedelta(seconds=event_time_sec)
-                        })
-                        all_records.append(record)
+                    # 整组事件一次extend/append，时间换算走一次向量化运算，
+                    # 不再逐事件进Python循环
+                    n = len(event_times)
+                    if n == 0:
+                        return
+                    event_trial_rows.extend([trial_row] * n)
+                    event_code_col.extend([event_type] * n)
+                    event_time_chunks.append((np.asarray(event_times, dtype=np.float64) + start_time_ms) / 1000.0)
 
                 # AnalogData提取
                 analog_data = trial_data.get('AnalogData', {})
-                touch_data = analog_data.get('Touch', np.array([]))
+                # loadmat(simplify_cells=True)返回的Touch本身就是ndarray，
+                # 不再套np.array重复拷贝，缺失时也不额外分配空数组
+                touch_data = analog_data.get('Touch')
                 button_data = analog_data.get('Button', {})
-                if touch_data.size > 0:
-                    touch_times = np.where((~pd.isna(np.array(trial_data['AnalogData']['Touch'])[:,0])==True))[0] # 触摸屏幕的时间，以ms采样，如果持续10ms，则结果类似于 [0, 1, 2, ..., 9]
-                    touch_start_time = touch_times[np.where(np.diff(touch_times) > 1)[0]+1] # 找到触摸开始的时间点
-                    touch_end_time = touch_times[np.where(np.diff(touch_times) > 1)[0]] # 找到触摸结束的时间点
+                if touch_data is not None and getattr(touch_data, 'size', 0) > 0:
+                    # 触摸以ms采样：有效(非NaN)序列做一次diff，上升/下降沿
+                    # 即触摸开始/结束，与下面按钮的检测方式一致
+                    valid_touch = ~np.isnan(touch_data[:, 0])
+                    touch_edges = np.diff(valid_touch.astype(np.int8))
+                    touch_start_time = np.flatnonzero(touch_edges == 1) + 1  # 找到触摸开始的时间点
+                    touch_end_time = np.flatnonzero(touch_edges == -1) + 1  # 找到触摸结束的时间点
                 else:
                     touch_start_time = np.array([])
                     touch_end_time = np.array([])
-                if button_data is not {}:
-                    btn1_data = button_data.get('Btn1', []).astype(np.int8)  # 确保数据是整数类型
-                    btn1_start_time = np.where(np.diff(btn1_data) == 1)[0] + 1  # 按下按钮的时间，以ms采样，如果持续10ms，则结果类似于 [0, 1, 2, ..., 9]
-                    btn1_end_time = np.where(np.diff(btn1_data) == -1)[0] + 1  # 找到按钮释放的时间点
+                if button_data:  # 原先的`is not {}`恒为True，Button缺失时会崩溃
+                    btn1_data = np.asarray(button_data.get('Btn1', []), dtype=np.int8)  # 确保数据是整数类型
+                    btn1_edges = np.diff(btn1_data)
+                    btn1_start_time = np.flatnonzero(btn1_edges == 1) + 1  # 按下按钮的时间点
+                    btn1_end_time = np.flatnonzero(btn1_edges == -1) + 1  # 找到按钮释放的时间点
                 else:
                     btn1_start_time = np.array([])
                     btn1_end_time = np.array([])
@@ -147,18 +161,37 @@ class MatLoader(BaseLoader):
                 record_event('Button1Start', btn1_start_time)
                 record_event('Button1End', btn1_end_time)
 
-                # Behavioral提取
+                # Behavioral提取：同样按trial整批落列
                 behavioral_codes = trial_data.get('BehavioralCodes', {})
-                codes = behavioral_codes.get('CodeNumbers', [])
-                times = behavioral_codes.get('CodeTimes', [])
-
-                for code, time_ms in zip(codes, times):
-                    record_event(code, [time_ms])
+                codes = np.atleast_1d(behavioral_codes.get('CodeNumbers', []))
+                times = np.atleast_1d(behavioral_codes.get('CodeTimes', []))
+                if codes.size > 0:
+                    event_trial_rows.extend([trial_row] * codes.size)
+                    event_code_col.extend(codes.tolist())
+                    event_time_chunks.append((times.astype(np.float64) + start_time_ms) / 1000.0)
 
             except KeyError as e:
                 logging.warning(f"KeyError {e} while processing Trial {trial_id}. Skipping trial.")
 
-        return pd.DataFrame(all_records)
+        if not event_time_chunks:
+            return pd.DataFrame()
+
+        df = pd.DataFrame(trial_infos).iloc[event_trial_rows].reset_index(drop=True)
+        df['BehavioralCode'] = event_code_col
+        event_times_sec = np.concatenate(event_time_chunks)
+        df['EventTime'] = event_times_sec
+        # 对速度敏感且不需要日历时间的加载可以用include_datetime=False跳过整列转换
+        if kwargs.get('include_datetime', True):
+            # 单次C层向量化转换，取代逐事件的Python datetime加法
+            df['AbsoluteDateTime'] = pd.Timestamp(start_datetime) + pd.to_timedelta(event_times_sec, unit='s')
+        # 显式声明已知列的dtype，跳过pandas的逐列推断，
+        # 数值列降位宽+事件码转category可把返回表的内存压缩2-4倍
+        dtype_map = {
+            'TrialID': 'int32', 'TrialError': 'int8',
+            'Direction': 'float32', 'Coherence': 'float32',
+            'BehavioralCode': 'category', 'EventTime': 'float64',
+        }
+        return df.astype({col: dt for col, dt in dtype_map.items() if col in df.columns})
 
 class DataFrameLoader(BaseLoader):
     """一个简单的加载器，直接使用传入的DataFrame作为数据源。"""
@@ -1,34 +1,105 @@
-import dtw
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
-from collections import defaultdict
-
-def get_pair_via_dtw(template, query, step_pattern="symmetric2", verbose=False):
-    template = np.diff(template)
-    query = np.diff(query)
-    dist_fun = lambda x_val, y_val: abs(x_val - y_val)
-    alignment_default = dtw.dtw(template, query,
-                        dist_method=dist_fun,
-                        step_pattern=step_pattern, # 或者 rabinerJuangStepPattern(6, "c"))\
-                        keep_internals=True)
-    # 获取结果
-    distance_default = alignment_default.distance         # DTW距离
-    path_s1_default = alignment_default.index1            # s1 中点的索引序列
-    path_s2_default = alignment_default.index2            # s2 中点的索引序列
-    cost_matrix_default = alignment_default.costMatrix    # 累积代价矩阵
-    local_cost_matrix_default = alignment_default.localCostMatrix # 局部代价矩阵
-
-
-    path_pairs_default = list(zip(path_s1_default, path_s2_default))
-
-    # 希望在最前面增加一个(-1,-1), 因为之前采取的是差值匹配，会少一个数值
-    path_pairs_default = [(-1, -1)] + path_pairs_default
-    # 对所有元素+1，这样回归到从0开始的索引
-    path_pairs_default = [(i + 1, j + 1) for i, j in path_pairs_default]
+
+from . import _fastcore
+
+def get_pair_via_dtw(template, query, step_pattern="symmetric2", verbose=False, backend="auto", window=None,
+                     template_diff=None, query_diff=None, dtype=np.float64, bt_buffer=None):
+    """
+    用DTW对齐两个事件时间序列（差分后匹配间隔），返回(K, 2)的配对索引数组。
+
+    backend='auto'时，symmetric2且非verbose的调用在numba可用时走
+    jit内核（递推为原生循环，快一到两个数量级）；其余情况
+    （verbose绘图、其他step_pattern或numba缺失）走dtw-python。
+
+    window指定Sakoe-Chiba带宽（格子数）：两条序列基本同步时只需计算
+    对角线附近的窄带，把O(N·M)的代价降到O(N·window)。默认None为全矩阵。
+
+    批量对齐时同一条template会反复出现，可以把np.diff的结果算好后
+    经template_diff/query_diff传入，省掉每次调用的差分和新数组分配。
+
+    dtype=np.float32可将numba后端的递推降为4字节精度（事件间隔在ms
+    量级，24位尾数绰绰有余），内存带宽减半；dtw-python的C核只接受
+    double，该路径会保持float64。
+    """
+    template = (np.asarray(template_diff, dtype=dtype) if template_diff is not None
+                else np.diff(template).astype(dtype))
+    query = (np.asarray(query_diff, dtype=dtype) if query_diff is not None
+             else np.diff(query).astype(dtype))
+    # 差分匹配至少需要每边两个事件（一个间隔）；空diff喂给不做边界
+    # 检查的jit内核会越界读写，这里统一拦下，各后端行为一致
+    if template.size == 0 or query.size == 0:
+        raise ValueError("get_pair_via_dtw needs at least 2 events on each side "
+                         "(got empty interval sequences after np.diff).")
+    if backend == "auto":
+        use_numba = _fastcore.NUMBA_AVAILABLE and step_pattern == "symmetric2" and not verbose
+    elif backend == "numba":
+        # verbose绘图依赖dtw-python的alignment对象，numba后端不支持
+        use_numba = not verbose
+        if not _fastcore.NUMBA_AVAILABLE:
+            print("Warning: numba is not installed. Falling back to the dtw-python backend.")
+            use_numba = False
+    else:
+        use_numba = False
+
+    if use_numba:
+        # 回溯方向码矩阵可经bt_buffer跨调用复用（见AlignerContext）
+        if bt_buffer is not None:
+            # 内核不做边界检查，缓冲太小必须在切片前拒绝，否则越界写内存
+            if bt_buffer.shape[0] < template.size or bt_buffer.shape[1] < query.size:
+                raise ValueError(
+                    f"bt_buffer shape {bt_buffer.shape} is smaller than the required "
+                    f"({template.size}, {query.size}).")
+            bt = bt_buffer[:template.size, :query.size]
+        else:
+            bt = np.empty((template.size, query.size), np.uint8)
+        if window is None:
+            # 全矩阵时走反对角线wavefront内核，内循环可被SIMD向量化
+            path_s1_default, path_s2_default = _fastcore._dtw_sym2_diag(template, query, bt)
+        else:
+            path_s1_default, path_s2_default = _fastcore._dtw_sym2(template, query, int(window), bt)
+        if path_s1_default.size == 0:
+            raise ValueError(f"Sakoe-Chiba window ({window}) is too narrow to connect the two sequences.")
+    else:
+        # dtw-python只在真正用到时才导入：numba后端的批量对齐worker
+        # 完全不必付dtw包（连带scipy）约0.3s的冷导入和相应RSS
+        import dtw
+        # dtw-python的C核只接受double的代价矩阵，float32在这条路径不可用
+        template = template.astype(np.float64, copy=False)
+        query = query.astype(np.float64, copy=False)
+        # 用一次向量化的outer运算预先算好L1局部代价矩阵；
+        # dtw.dtw收到2D输入会当作precomputed cost matrix使用，
+        # 不再对Python的dist_fun lambda做O(N·M)次逐格回调
+        local_cost = np.abs(np.subtract.outer(template, query))
+        # 只有verbose绘图才需要保留costMatrix/localCostMatrix两个N×M矩阵，
+        # 非verbose路径不保留，省掉一半峰值内存和对应的写回流量
+        window_kwargs = {}
+        if window is not None:
+            window_kwargs = {'window_type': 'sakoechiba', 'window_args': {'window_size': int(window)}}
+        alignment_default = dtw.dtw(local_cost,
+                            step_pattern=step_pattern, # 或者 rabinerJuangStepPattern(6, "c"))\
+                            keep_internals=verbose,
+                            **window_kwargs)
+        # 获取结果
+        distance_default = alignment_default.distance         # DTW距离
+        path_s1_default = alignment_default.index1            # s1 中点的索引序列
+        path_s2_default = alignment_default.index2            # s2 中点的索引序列
+
+
+    # 差值匹配会少一个数值，在最前面补一对(-1,-1)再整体+1回到从0开始的索引；
+    # 直接组装成(K,2)的int64数组，免去Python元组列表的逐元素装箱
+    path_pairs_default = np.empty((len(path_s1_default) + 1, 2), dtype=np.int64)
+    path_pairs_default[0] = 0
+    path_pairs_default[1:, 0] = np.asarray(path_s1_default) + 1
+    path_pairs_default[1:, 1] = np.asarray(path_s2_default) + 1
 
     if verbose:
         print(f"--- 使用 dtw-python ( {step_pattern} 步进模式) ---")
         print(f"DTW 距离: {distance_default:.2f}")
-        dtw.dtwPlot(alignment_default,type="twoway")
+        # twoway图需要原始序列，precomputed cost matrix模式下不可用，只画density
         dtw.dtwPlot(alignment_default,type="density")
         print(f"匹配结果（template点的id, query点的id） :\n {path_pairs_default}")
         # print(rabinerJuangStepPattern(6,"c"))
@@ -36,84 +107,171 @@ def get_pair_via_dtw(template, query, step_pattern="symmetric2", verbose=False):
 
     return path_pairs_default
 
-def _purify_pairs(pairs, key_index=0):
+class AlignerContext:
+    """
+    跨多次DTW对齐复用的预分配缓冲区。
+
+    逐次调用get_pair_via_dtw时，每次都要为差分序列和回溯方向码矩阵
+    各malloc一回；上千次对齐下分配器本身会成为热点。本类按最大序列
+    长度一次性分配好这些缓冲，align()用np.subtract(..., out=)原地写
+    差分、把方向码矩阵的切片视图交给jit内核，单次调用不再产生大块
+    分配。缓冲为float64，与默认dtype一致。
+
+    注意：同一个context持有共享缓冲，不能在多线程/多进程间并用；
+    进程池批量对齐请在每个worker里各建一个。
+    """
+    def __init__(self, max_template_len, max_query_len):
+        self._diff_a = np.empty(max_template_len - 1)
+        self._diff_b = np.empty(max_query_len - 1)
+        self._bt = np.empty((max_template_len - 1, max_query_len - 1), np.uint8)
+
+    def align(self, template, query, **kwargs):
+        """对齐一对序列，语义同get_pair_via_dtw，额外的kwargs原样透传。"""
+        template = np.asarray(template)
+        query = np.asarray(query)
+        template_diff = self._diff_a[:template.size - 1]
+        np.subtract(template[1:], template[:-1], out=template_diff)
+        query_diff = self._diff_b[:query.size - 1]
+        np.subtract(query[1:], query[:-1], out=query_diff)
+        return get_pair_via_dtw(template, query,
+                                template_diff=template_diff, query_diff=query_diff,
+                                bt_buffer=self._bt, **kwargs)
+
+def _align_one(args, **kwargs):
+    """get_pairs_batch的进程池入口：解包一对(template, query)并对齐。"""
+    template, query = args
+    return get_pair_via_dtw(template, query, **kwargs)
+
+def get_pairs_batch(templates, queries, n_jobs=-1, **kwargs):
+    """
+    批量对齐多对(template, query)序列，每对相互独立，用进程池并行。
+
+    dtw-python的递推基本不释放GIL，线程并不能真正并行，所以这里用
+    标准库的ProcessPoolExecutor按对分发；额外的kwargs原样透传给
+    get_pair_via_dtw。n_jobs=-1用满所有核，n_jobs=1退化为串行循环
+    （对少量短序列省去进程启动开销）。
+
+    Returns:
+        list: 每对序列各一个(K, 2)的配对索引数组，顺序与输入一致。
+    """
+    align_args = list(zip(templates, queries))
+    if n_jobs == 1 or len(align_args) <= 1:
+        return [get_pair_via_dtw(t, q, **kwargs) for t, q in align_args]
+
+    max_workers = os.cpu_count() if n_jobs is None or n_jobs < 0 else n_jobs
+    max_workers = min(max_workers, len(align_args))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(partial(_align_one, **kwargs), align_args))
+
+def _purify_pairs(keys, values):
     """
-    一个通用的配对列表清理函数，确保基于 key_index 的唯一性。
+    向量化的配对清理：对每个key只保留value最小的那一对。
+
+    用lexsort先按key、再按value排序，每个key组的第一个元素即最小value，
+    相比逐对的Python循环+defaultdict分组只需一次O(K log K)排序。
 
     Args:
-        pairs (list): (id_A, id_B) 格式的配对列表。
-        key_index (int): 指定作为Key的索引 (0 或 1)。
+        keys (np.ndarray): 作为Key的一列id。
+        values (np.ndarray): 与keys等长的一列value。
 
     Returns:
-        list: 清理后的配对列表。
+        tuple: (唯一的keys, 对应的最小values)。
     """
-    if not pairs:
-        return []
-
-    value_index = 1 - key_index
-    
-    # 按指定的 key 进行分组
-    key_to_values_map = defaultdict(list)
-    for pair in pairs:
-        key = pair[key_index]
-        value = pair[value_index]
-        key_to_values_map[key].append(value)
-        
-    # 解决冲突，并构建纯净的配对列表
-    purified_pairs = []
-    for key, values in key_to_values_map.items():
-        # 决策规则：保留value最小的那个
-        best_value = min(values)
-        
-        # 重新组装配对，注意保持原始的 (id_A, id_B) 顺序
-        if key_index == 0:
-            purified_pairs.append((key, best_value))
-        else:
-            purified_pairs.append((best_value, key))
-            
-    return purified_pairs
+    order = np.lexsort((values, keys))
+    keys_sorted = keys[order]
+    values_sorted = values[order]
+    # 每个key组在排序后的首个位置
+    is_first = np.ones(keys_sorted.size, dtype=bool)
+    is_first[1:] = keys_sorted[1:] != keys_sorted[:-1]
+    return keys_sorted[is_first], values_sorted[is_first]
 
 def get_paired_ephys_event_index(task_ephys_dtw_pairs, conservative=False):
     """
     【最终重构版】
     将DTW配对转换为task索引到ephys索引的映射数组。
     通过连续调用两次通用清理函数来确保最终映射的双向唯一性。
+    整个流程为向量化的排序+一次scatter赋值，没有逐对的Python循环。
     """
+    pairs = np.asarray(task_ephys_dtw_pairs, dtype=np.int64)
+    if pairs.size == 0:
+        return np.array([])
+    task_ids = np.ascontiguousarray(pairs[:, 0])
+    ephys_ids = np.ascontiguousarray(pairs[:, 1])
+
+    # numba可用时走jit内核：两趟原生循环完成净化+scatter，免去lexsort
+    if _fastcore.NUMBA_AVAILABLE:
+        return _fastcore._pair_scatter(task_ids, ephys_ids, conservative)
+
     # 原始DTW配对可能包含两种冲突
-    
     if not conservative:
-        # 第一步：清理“一个Ephys对多个Task”的冲突 (key_index=1, 按ephys_id分组)
-        clean_pairs_stage1 = _purify_pairs(task_ephys_dtw_pairs, key_index=1)
+        # 第一步：清理“一个Ephys对多个Task”的冲突 (按ephys_id分组，保留最小task_id)
+        ephys_ids, task_ids = _purify_pairs(ephys_ids, task_ids)
 
-        # 第二步：清理“一个Task对多个Ephys”的冲突 (key_index=0, 按task_id分组)
-        # 输入是上一阶段的输出
-        final_clean_pairs = _purify_pairs(clean_pairs_stage1, key_index=0)
-    else:
-        # 保守模式下，直接进行第二步清理
-        final_clean_pairs = _purify_pairs(task_ephys_dtw_pairs, key_index=0)
-    
-    # 第三步：使用完全纯净的配对列表构建最终数组
-    if not final_clean_pairs:
-        return np.array([])
-        
-    max_task_id = max(pair[0] for pair in final_clean_pairs)
-    final_numpy_array = np.full(max_task_id + 1, np.nan)
-    
-    # 因为 final_clean_pairs 中的 task_event_id 已经是唯一的，所以可以直接赋值
-    for task_event_id, ephys_event_id in final_clean_pairs:
-        final_numpy_array[task_event_id] = ephys_event_id
+    # 第二步：清理“一个Task对多个Ephys”的冲突 (按task_id分组，保留最小ephys_id)
+    task_ids, ephys_ids = _purify_pairs(task_ids, ephys_ids)
+
+    # 第三步：task_id此时已唯一，一次scatter写入最终数组
+    final_numpy_array = np.full(task_ids.max() + 1, np.nan)
+    final_numpy_array[task_ids] = ephys_ids
 
     return final_numpy_array
 
 def get_spikes_in_windows(spike_train, event_windows):
     """
-    使用列表推导式，更简洁地提取窗口内的相对spike time。
+    用searchsorted二分定位提取各窗口内的相对spike time。
+
+    spike train天然按时间递增，排好序后每个窗口[start, end)对应一段
+    连续切片，两次向量化的searchsorted就能定出全部边界——相比逐窗口
+    的布尔掩码扫描，总开销从O(W·S)降到O((W+S)·log S)，且不再为每个
+    窗口分配一个S长的掩码数组。
+    """
+    spike_train = np.asarray(spike_train)
+    event_windows = np.asarray(event_windows)
+
+    # 多数情况下输入已有序，先检查避免不必要的排序拷贝
+    if spike_train.size > 1 and not np.all(np.diff(spike_train) >= 0):
+        spike_train = np.sort(spike_train)
+
+    starts = event_windows[:, 0]
+    lo = np.searchsorted(spike_train, starts, side='left')
+    hi = np.searchsorted(spike_train, event_windows[:, 1], side='left')
+
+    return [spike_train[l:h] - s for l, h, s in zip(lo, hi, starts)]
+
+def get_spikes_in_windows_flat(spike_train, event_windows):
+    """
+    get_spikes_in_windows的扁平(CSR)版本：返回(flat, offsets)。
+
+    list-of-arrays每个窗口都是一次独立的小分配，下游逐窗口处理时
+    缓存不友好；这里把所有窗口的相对spike time拼进一个连续的float64
+    数组，offsets为int64[W+1]，flat[offsets[k]:offsets[k+1]]即第k个
+    窗口。整个提取是一次向量化gather，下游的直方图/ISI等统计可以在
+    一个连续数组上单趟完成。
     """
     spike_train = np.asarray(spike_train)
     event_windows = np.asarray(event_windows)
 
-    # 一行列表推导式完成所有操作
-    return [
-        spike_train[(spike_train >= start) & (spike_train < end)] - start
-        for start, end in event_windows
-    ]
\ No newline at end of file
+    if spike_train.size > 1 and not np.all(np.diff(spike_train) >= 0):
+        spike_train = np.sort(spike_train)
+
+    starts = event_windows[:, 0]
+    lo = np.searchsorted(spike_train, starts, side='left')
+    hi = np.searchsorted(spike_train, event_windows[:, 1], side='left')
+
+    counts = hi - lo
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # numba可用时用prange内核并行搬运各窗口切片；各窗口的输出区间
+    # 互不重叠，线程间无写冲突
+    if _fastcore.NUMBA_AVAILABLE:
+        flat = np.empty(offsets[-1], dtype=np.float64)
+        _fastcore._spikes_in_windows(
+            np.ascontiguousarray(spike_train, dtype=np.float64),
+            lo, hi, np.ascontiguousarray(starts, dtype=np.float64),
+            offsets, flat)
+        return flat, offsets
+
+    # 把每个窗口的切片区间展开成一个全局索引向量，一次gather完成拷贝
+    indices = np.arange(offsets[-1]) + np.repeat(lo - offsets[:-1], counts)
+    flat = spike_train[indices] - np.repeat(starts, counts)
+    return flat, offsets
\ No newline at end of file